@@ -5,8 +5,9 @@ https://github.com/pypa/sampleproject
 """
 
 # To use a consistent encoding
+import warnings
 from codecs import open
-from os import path
+from os import environ, path
 
 # Always prefer setuptools over distutils
 from setuptools import setup
@@ -15,12 +16,26 @@ from setuptools import setup
 try:
     import pypandoc
 
-    long_description = pypandoc.convert('README.md', 'rst')
+    long_description = pypandoc.convert_file('README.md', 'rst')
 except (IOError, ImportError):
     long_description = open('README.md').read()
 
 here = path.abspath(path.dirname(__file__))
 
+# Optionally compile the order rendering module with mypyc (TRUSTPAY_USE_MYPYC=1),
+# the pure python module is used when the extension isn't built or mypy isn't installed.
+# mypy isn't a build requirement, so build without pip's isolation:
+# TRUSTPAY_USE_MYPYC=1 pip install --no-build-isolation .
+ext_modules = []
+if environ.get('TRUSTPAY_USE_MYPYC') == '1':
+    try:
+        from mypyc.build import mypycify
+    except ImportError:
+        warnings.warn('TRUSTPAY_USE_MYPYC is set but mypyc is not importable, '
+                      'building the pure python package')
+    else:
+        ext_modules = mypycify(['trustpay/_render.py'])
+
 # Get the long description from the README file
 # with open(path.join(here, 'README.rst'), encoding='utf-8') as f:
 #    long_description = f.read()
@@ -57,4 +72,9 @@ setup(
     packages=['trustpay'],
 
     install_requires=['requests'],
+    ext_modules=ext_modules,
+    extras_require={
+        'fast': ['orjson'],
+        'async': ['httpx[http2]'],
+    },
 )
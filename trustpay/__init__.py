@@ -2,6 +2,10 @@ class PaymentException(Exception):
     pass
 
 
+class UnsupportedCurrencyException(PaymentException, ValueError):
+    pass
+
+
 order_xml_string = '''<?xml version="1.0" encoding="UTF-8"?>
 <Document xmlns:xsd="http://www.w3.org/2001/XMLSchema"
           xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
@@ -68,4 +72,22 @@ order_xml_string = '''<?xml version="1.0" encoding="UTF-8"?>
             </CdtTrfTxInf>
         </PmtInf>
     </CstmrCdtTrfInitn>
-</Document>'''
\ No newline at end of file
+</Document>'''
+
+
+# whitespace between tags collapsed once at import time so rendered orders
+# don't have to be post-processed
+order_xml_compact = (
+    " ".join(order_xml_string.split()).replace(" <", "<").replace("> ", ">")
+)
+
+# the same document split around the transaction block, so a batch order can
+# be rendered with one CdtTrfTxInf per transfer
+_transaction_start = order_xml_compact.index("<CdtTrfTxInf>")
+_transaction_end = order_xml_compact.index("</CdtTrfTxInf>") + len("</CdtTrfTxInf>")
+
+batch_order_xml_header = order_xml_compact[:_transaction_start].replace(
+    "<NbOfTxs>1</NbOfTxs>", "<NbOfTxs>{NumberOfTransactions}</NbOfTxs>"
+)
+order_transaction_xml = order_xml_compact[_transaction_start:_transaction_end]
+batch_order_xml_footer = order_xml_compact[_transaction_end:]
@@ -0,0 +1,150 @@
+"""
+Order XML rendering, kept free of I/O so it can be compiled with mypyc
+"""
+import re
+from typing import Any, Dict, List, Tuple
+from xml.sax.saxutils import escape
+
+from . import (
+    batch_order_xml_footer,
+    batch_order_xml_header,
+    order_transaction_xml,
+    order_xml_compact,
+)
+
+_ATTRIBUTE_ENTITIES = {'"': "&quot;"}
+
+
+def escape_values(config: Dict[str, Any]) -> Dict[str, str]:
+    # values end up in element text and the Ccy attribute of the order xml
+    return {
+        key: escape(str(value), _ATTRIBUTE_ENTITIES) for key, value in config.items()
+    }
+
+
+def _fragments(xml_string: str, fields: Tuple[str, ...]) -> Tuple[str, ...]:
+    # constant text between the placeholders, checked against the field order
+    # the renderers below are written for
+    parts = re.split(r"\{(\w+)\}", xml_string)
+    if tuple(parts[1::2]) != fields:
+        raise ValueError(f"Unexpected order template fields: {parts[1::2]}")
+    return tuple(parts[0::2])
+
+
+_ORDER = _fragments(
+    order_xml_compact,
+    (
+        "MessageId",
+        "CreationDateTime",
+        "RequestedExecutionDate",
+        "DebtorName",
+        "DebtorAccount",
+        "Currency",
+        "Amount",
+        "CreditorBankBic",
+        "CreditorName",
+        "CreditorAccount",
+        "Description",
+    ),
+)
+_BATCH_HEADER = _fragments(
+    batch_order_xml_header,
+    (
+        "MessageId",
+        "CreationDateTime",
+        "NumberOfTransactions",
+        "RequestedExecutionDate",
+        "DebtorName",
+        "DebtorAccount",
+    ),
+)
+_TRANSACTION = _fragments(
+    order_transaction_xml,
+    (
+        "Currency",
+        "Amount",
+        "CreditorBankBic",
+        "CreditorName",
+        "CreditorAccount",
+        "Description",
+    ),
+)
+
+
+# the joins are written out so rendering is a single join with no template
+# parsing, and so mypyc can compile them
+
+
+def render_order(config: Dict[str, str]) -> str:
+    f = _ORDER
+    return "".join(
+        (
+            f[0],
+            config["MessageId"],
+            f[1],
+            config["CreationDateTime"],
+            f[2],
+            config["RequestedExecutionDate"],
+            f[3],
+            config["DebtorName"],
+            f[4],
+            config["DebtorAccount"],
+            f[5],
+            config["Currency"],
+            f[6],
+            config["Amount"],
+            f[7],
+            config["CreditorBankBic"],
+            f[8],
+            config["CreditorName"],
+            f[9],
+            config["CreditorAccount"],
+            f[10],
+            config["Description"],
+            f[11],
+        )
+    )
+
+
+def _render_transaction(transfer: Dict[str, str]) -> str:
+    f = _TRANSACTION
+    return "".join(
+        (
+            f[0],
+            transfer["Currency"],
+            f[1],
+            transfer["Amount"],
+            f[2],
+            transfer["CreditorBankBic"],
+            f[3],
+            transfer["CreditorName"],
+            f[4],
+            transfer["CreditorAccount"],
+            f[5],
+            transfer["Description"],
+            f[6],
+        )
+    )
+
+
+def render_batch_order(config: Dict[str, str], transfers: List[Dict[str, str]]) -> str:
+    f = _BATCH_HEADER
+    parts = [
+        f[0],
+        config["MessageId"],
+        f[1],
+        config["CreationDateTime"],
+        f[2],
+        config["NumberOfTransactions"],
+        f[3],
+        config["RequestedExecutionDate"],
+        f[4],
+        config["DebtorName"],
+        f[5],
+        config["DebtorAccount"],
+        f[6],
+    ]
+    for transfer in transfers:
+        parts.append(_render_transaction(transfer))
+    parts.append(batch_order_xml_footer)
+    return "".join(parts)
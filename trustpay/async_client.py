@@ -0,0 +1,236 @@
+import asyncio
+from importlib.util import find_spec
+from typing import Callable, List, Optional, Union
+
+import httpx
+
+from . import PaymentException
+from .client import (
+    _TOKEN_CACHE_LOCK,
+    ACCOUNT_DETAILS_ENDPOINT,
+    CREATE_ORDER_ENDPOINT,
+    DEFAULT_ACCOUNT_DETAILS_TTL,
+    TOKEN_ENDPOINT,
+    TOKEN_REQUEST_BODY,
+    _dumps,
+    _TrustpayBase,
+    logger,
+)
+
+# connection limits for the shared async http client
+MAX_CONNECTIONS = 32
+MAX_KEEPALIVE_CONNECTIONS = 16
+
+# multiplex concurrent requests over one connection when httpx can speak HTTP/2
+HTTP2_AVAILABLE = find_spec("h2") is not None
+
+
+class AsyncTrustpay(_TrustpayBase):
+    """
+    Trustpay client built on httpx.AsyncClient, so independent calls
+    (e.g. several send_money orders) can be awaited concurrently and share
+    pooled connections. Signing, headers, urls and order rendering are
+    shared with the sync client. Use it with `async with` or call aclose().
+    """
+
+    __slots__ = ("_client", "_token_lock")
+
+    def __init__(
+        self,
+        password,
+        username,
+        secret_key=None,
+        aid=None,
+        api_url=None,
+        debug=False,
+        account_details_ttl=DEFAULT_ACCOUNT_DETAILS_TTL,
+    ):
+        super().__init__(
+            password,
+            username,
+            secret_key=secret_key,
+            aid=aid,
+            api_url=api_url,
+            debug=debug,
+            account_details_ttl=account_details_ttl,
+        )
+
+        # http client and token lock are created inside the running event loop
+        self._client = None
+        self._token_lock = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.aclose()
+
+    async def aclose(self):
+        """
+        Release pooled connections held by the http client
+        """
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                http2=HTTP2_AVAILABLE,
+                limits=httpx.Limits(
+                    max_connections=MAX_CONNECTIONS,
+                    max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                ),
+            )
+        return self._client
+
+    async def _prepare_headers(self, with_access_token=True):
+        if with_access_token:
+            await self.get_access_token()
+            return self._bearer_header
+
+        return self._basic_auth_header
+
+    async def _send_request(
+        self,
+        endpoint: str,
+        data: Union[dict, str],
+        headers: dict,
+        transform_data_func: Optional[Callable],
+    ):
+        if transform_data_func is not None:
+            post_params = transform_data_func(data)
+        else:
+            post_params = data
+
+        r = await self._post(endpoint, headers, post_params)
+        if r.status_code == 401 and headers is self._bearer_header:
+            # the token was rejected before its reported expiry, refresh it and retry
+            self._invalidate_access_token()
+            r = await self._post(endpoint, await self._prepare_headers(), post_params)
+
+        return self._parse_response(r)
+
+    async def _post(self, endpoint: str, headers: dict, post_params) -> httpx.Response:
+        url = self._generate_url(endpoint)
+        if self.debug:
+            logger.info("Trustpay request: url=%s; body=%s", url, post_params)
+        r = await self._get_client().post(url, headers=headers, content=post_params)
+        if self.debug:
+            logger.info("Trustpay response: %s", r.content)
+        return r
+
+    async def get_access_token(self) -> str:
+        """
+        Async variant of Trustpay.get_access_token, shares the same token cache
+
+        :return access_token:str
+        """
+        with _TOKEN_CACHE_LOCK:
+            access_token = self._cached_access_token()
+        if access_token:
+            return access_token
+
+        if self._token_lock is None:
+            self._token_lock = asyncio.Lock()
+
+        # only one coroutine per client requests a new token
+        async with self._token_lock:
+            with _TOKEN_CACHE_LOCK:
+                access_token = self._cached_access_token()
+            if access_token:
+                return access_token
+
+            endpoint = TOKEN_ENDPOINT
+
+            headers = await self._prepare_headers(with_access_token=False)
+
+            result = await self._send_request(
+                endpoint, TOKEN_REQUEST_BODY, headers, None
+            )
+            with _TOKEN_CACHE_LOCK:
+                return self._store_access_token(result)
+
+    async def account_details(self) -> dict:
+        """
+        Async variant of Trustpay.account_details
+        """
+        endpoint = ACCOUNT_DETAILS_ENDPOINT
+        data = {"AccountId": self.aid}
+        headers = await self._prepare_headers()
+        result = await self._send_request(endpoint, data, headers, _dumps)
+        return self._store_account_details(result)
+
+    async def _account_details_for_order(self) -> dict:
+        return self._cached_account_details() or await self.account_details()
+
+    async def _create_order(self, order_data: str) -> dict:
+        endpoint = CREATE_ORDER_ENDPOINT
+        data_to_send = {"Xml": order_data}
+        headers = await self._prepare_headers()
+
+        try:
+            return await self._send_request(endpoint, data_to_send, headers, _dumps)
+        except PaymentException:
+            # the order may have been rejected because of stale account details
+            self._account_details_cache = None
+            raise
+
+    async def send_money(
+        self,
+        amount: float,
+        currency: str,
+        recipient: str,
+        account: str,
+        details: str,
+        bank_bik: str = "NOTPROVIDED",
+    ) -> dict:
+        """
+        Async variant of Trustpay.send_money
+        """
+        self._check_currency(currency)
+
+        account_details = await self._account_details_for_order()
+        order_data = self._render_order(
+            account_details, amount, currency, recipient, account, details, bank_bik
+        )
+
+        return await self._create_order(order_data)
+
+    async def send_money_batch(self, transfers: List[dict]) -> dict:
+        """
+        Async variant of Trustpay.send_money_batch
+        """
+        self._check_transfers(transfers)
+
+        account_details = await self._account_details_for_order()
+        order_data = self._render_batch_order(account_details, transfers)
+
+        return await self._create_order(order_data)
+
+    async def send_money_many(
+        self, transfers: List[dict]
+    ) -> List[Union[dict, BaseException]]:
+        """
+        Create a separate order for every transfer, all requests run concurrently
+
+        Orders are independent: a failed order doesn't stop or undo the others,
+        so the result of every transfer is returned instead of raising on the
+        first error. Check each item before treating its transfer as sent.
+
+        :param transfers: non-empty list of dicts with the send_money keyword arguments
+        :return: list in the same order as transfers, holding either the
+            Trustpay API response (e.g. {"OrderId": 123123}) or the exception
+            (usually PaymentException) raised for that transfer
+        """
+        self._check_transfers(transfers)
+
+        # fetch token and account details once instead of in every order
+        await self._account_details_for_order()
+
+        return list(
+            await asyncio.gather(
+                *(self.send_money(**transfer) for transfer in transfers),
+                return_exceptions=True,
+            )
+        )
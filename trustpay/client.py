@@ -2,28 +2,96 @@ import base64
 import hashlib
 import hmac
 import json
-import uuid
+import secrets
 import logging
+import threading
+import time
 
-from datetime import date, datetime
-from http import HTTPStatus
-from typing import Optional
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 from urllib.parse import urlencode
-from . import order_xml_string
+from ._render import escape_values, render_batch_order, render_order
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from . import PaymentException
+from . import PaymentException, UnsupportedCurrencyException
+
+# prefer a C-accelerated json implementation when one is installed
+_dumps: Callable[[Any], Union[str, bytes]]
+_loads: Callable[[Union[str, bytes]], Any]
+try:
+    import orjson
+
+    _dumps = orjson.dumps
+    _loads = orjson.loads
+except ImportError:
+    try:
+        import ujson  # type: ignore
+
+        _dumps = ujson.dumps
+        _loads = ujson.loads
+    except ImportError:
+        _dumps = json.dumps
+        _loads = json.loads
 
 # DEFAULT_BASE_API_URL = 'https://api.trustpay.eu/api/oauth2/token'
 DEFAULT_BASE_API_URL = "https://api.trustpay.eu"
-SUPPORTED_CURRENCIES = ["EUR"]
+SUPPORTED_CURRENCIES = frozenset({"EUR"})
+_SUPPORTED_CURRENCIES_STR = ", ".join(sorted(SUPPORTED_CURRENCIES))
+
+TOKEN_ENDPOINT = "/api/oauth2/token"
+ACCOUNT_DETAILS_ENDPOINT = "/ApiBanking/GetAccountDetails"
+CREATE_ORDER_ENDPOINT = "/ApiBanking/CreateOrder"
+
+# the token request form never changes, so it is encoded once
+TOKEN_REQUEST_BODY = urlencode({"grant_type": "client_credentials"})
+
+# fallback token lifetime (seconds) when the token endpoint doesn't report one
+DEFAULT_TOKEN_TTL = 3600
+
+# refresh the token this many seconds before it actually expires
+TOKEN_EXPIRY_MARGIN = 60
+
+# how long (seconds) send_money reuses the merchant account details
+DEFAULT_ACCOUNT_DETAILS_TTL = 300
+
+# (username, password hash, api_url) -> (access_token, monotonic expiry time)
+_TOKEN_CACHE: Dict[Tuple[str, str, str], Tuple[str, float]] = {}
+# one lock per cache key, so only one thread requests a token for the same credentials
+_TOKEN_FETCH_LOCKS: Dict[Tuple[str, str, str], threading.Lock] = {}
+# guards the two dicts above, never held during network calls
+_TOKEN_CACHE_LOCK = threading.Lock()
+
+# connection pool settings for the http session
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 16
 
 logger = logging.getLogger(__name__)
 
 
 # https://doc.trustpay.eu/?curl&ShowAPIBanking=true
-class Trustpay:
+# credentials, caches, signing and order rendering shared by the sync and async clients
+class _TrustpayBase:
+    __slots__ = (
+        "aid",
+        "secret_key",
+        "password",
+        "username",
+        "api_url",
+        "access_token",
+        "debug",
+        "account_details_ttl",
+        "_hmac_template",
+        "_urls",
+        "_token_cache_key",
+        "_basic_auth_header",
+        "_bearer_header",
+        "_account_details_cache",
+        "_account_details_expiry",
+    )
+
     # account ID
     aid: str
 
@@ -40,14 +108,26 @@ class Trustpay:
     api_url: str
 
     # access token
-    access_token: str = None
+    access_token: Optional[str]
 
     # debug
-    debug: bool = False
+    debug: bool
+
+    # seconds account details are reused when creating orders
+    account_details_ttl: float
 
     def __init__(
-        self, password, username, secret_key=None, aid=None, api_url=None, debug=False
+        self,
+        password,
+        username,
+        secret_key=None,
+        aid=None,
+        api_url=None,
+        debug=False,
+        account_details_ttl=DEFAULT_ACCOUNT_DETAILS_TTL,
     ):
+        if isinstance(secret_key, str):
+            secret_key = secret_key.encode("utf-8")
         self.secret_key = secret_key
         self.aid = aid
         self.password = password
@@ -55,59 +135,307 @@ class Trustpay:
 
         self.api_url = api_url or DEFAULT_BASE_API_URL
 
-        self.access_token = self.get_access_token()
+        # HMAC-SHA-256 state with the key already absorbed, copied for every signature
+        self._hmac_template = None
+        if secret_key is not None:
+            self._hmac_template = hmac.new(secret_key, digestmod="sha256")
+
+        self._urls = {
+            endpoint: self.api_url + endpoint
+            for endpoint in (
+                TOKEN_ENDPOINT,
+                ACCOUNT_DETAILS_ENDPOINT,
+                CREATE_ORDER_ENDPOINT,
+            )
+        }
+
+        # token is fetched lazily on the first authenticated request and shared
+        # with other instances using the same credentials
+        self.access_token = None
         self.debug = debug
+        password_hash = hashlib.sha256(f"{self.password}".encode("utf-8")).hexdigest()
+        self._token_cache_key = (self.username, password_hash, self.api_url)
+
+        # request headers are built once and reused for every call
+        base_auth = base64.b64encode(f"{self.username}:{self.password}".encode("utf-8"))
+        self._basic_auth_header = {
+            "Authorization": f"Basic {base_auth.decode()}",
+            "Content-Type": "application/x-www-form-urlencoded",
+        }
+        self._bearer_header = {"Authorization": "", "Content-Type": "text/json"}
+
+        # account details used to fill the debtor part of orders
+        self.account_details_ttl = account_details_ttl
+        self._account_details_cache = None
+        self._account_details_expiry = 0
 
     def create_merchant_signature(self, aid, amount, currency, reference):
         # A message is created as concatenation of parameter values in this specified order:
         # Merchant redirect to TrustPay: AID, AMT, CUR, and REF
 
-        message = str(aid).encode("utf-8")
-        message += str(amount).encode("utf-8")
-        message += str(currency).encode("utf-8")
-        message += str(reference).encode("utf-8")
-        return self.sign(message)
+        return self.sign(f"{aid}{amount}{currency}{reference}".encode("utf-8"))
 
     def check_trustpay_signature(self, signature, trustpay_signature):
-        return trustpay_signature == signature
+        # a missing signature (e.g. no secret_key) never matches
+        if not signature or not trustpay_signature:
+            return False
+
+        # constant time comparison, doesn't leak how many leading chars match;
+        # str is compared as utf-8 bytes, compare_digest raises on non-ASCII str
+        if isinstance(signature, str):
+            signature = signature.encode("utf-8")
+        if isinstance(trustpay_signature, str):
+            trustpay_signature = trustpay_signature.encode("utf-8")
+        return hmac.compare_digest(trustpay_signature, signature)
 
     def sign(self, message):
-        try:
-            key = self.secret_key
+        if self._hmac_template is None:
+            return None
 
-            # HMAC-SHA-256 code (32 bytes) is generated using a key obtained from TrustPay
-            code = hmac.new(key, message, hashlib.sha256)
+        # HMAC-SHA-256 code (32 bytes) is generated using a key obtained from TrustPay
+        code = self._hmac_template.copy()
+        code.update(message)
 
-            # Then the code is converted to a string to be a hexadecimal representation of the code
-            hex = code.hexdigest()
+        # Then the code is converted to a string of 64 upper hexadecimal chars
+        return code.digest().hex().upper()
 
-            # Return 64 upper chars
-            return hex.upper()
-        except TypeError:
-            return None
+    def sign_many(self, messages: List[bytes]) -> List[Optional[str]]:
+        """
+        Sign several messages with the same key
+        """
+        return [self.sign(message) for message in messages]
 
-    def _prepare_headers(self, with_access_token=True):
-        # signature = self._make_signature(nonce, data, endpoint)
-        if with_access_token:
-            access_token = self.get_access_token()
-            authorization = f"bearer {access_token}"
-            return {"Authorization": authorization, "Content-Type": "text/json"}
+    def _set_access_token(self, access_token):
+        # update the bearer header only when the token actually changes
+        if access_token != self.access_token:
+            self._bearer_header["Authorization"] = f"bearer {access_token}"
+        self.access_token = access_token
 
-        base_auth = base64.b64encode(f"{self.username}:{self.password}".encode("utf-8"))
-        authorization = f"Basic {base_auth.decode()}"
+    def _invalidate_access_token(self):
+        # drop the shared entry unless another instance already replaced it
+        with _TOKEN_CACHE_LOCK:
+            cached = _TOKEN_CACHE.get(self._token_cache_key)
+            if cached and cached[0] == self.access_token:
+                del _TOKEN_CACHE[self._token_cache_key]
 
-        return {
-            "Authorization": authorization,
-            "Content-Type": "application/x-www-form-urlencoded",
+    def _generate_url(self, endpoint):
+        url = self._urls.get(endpoint)
+        if url is None:
+            url = self.api_url + endpoint
+        return url
+
+    @staticmethod
+    def _parse_response(r) -> dict:
+        if r.status_code != 200:
+            # decode directly, r.text may run charset detection over the body
+            error = r.content.decode(r.encoding or "utf-8", "replace")
+            raise PaymentException(
+                "Trustpay error: {}. Error code: {}".format(error, r.status_code)
+            )
+
+        return _loads(r.content)
+
+    def _cached_access_token(self) -> Optional[str]:
+        # caller holds _TOKEN_CACHE_LOCK
+        cached = _TOKEN_CACHE.get(self._token_cache_key)
+        if cached and time.monotonic() < cached[1] - TOKEN_EXPIRY_MARGIN:
+            self._set_access_token(cached[0])
+            return self.access_token
+        return None
+
+    def _store_access_token(self, result: dict) -> str:
+        # caller holds _TOKEN_CACHE_LOCK
+        ttl = result.get("expires_in", result.get("expires-in", DEFAULT_TOKEN_TTL))
+
+        access_token = result["access_token"]
+        self._set_access_token(access_token)
+        _TOKEN_CACHE[self._token_cache_key] = (access_token, time.monotonic() + int(ttl))
+        return access_token
+
+    def _store_account_details(self, result: dict) -> dict:
+        account_details = result["AccountDetails"]
+
+        # keep only what orders need, in a dict of our own, so callers changing
+        # the returned details can't alter the debtor data of later orders
+        self._account_details_cache = {
+            "AccountId": account_details["AccountId"],
+            "AccountName": account_details["AccountName"],
         }
+        self._account_details_expiry = time.monotonic() + self.account_details_ttl
+        return account_details
+
+    def _cached_account_details(self) -> Optional[dict]:
+        # orders only need the account id and name, which rarely change,
+        # so a recent response is reused instead of another round-trip
+        if (
+            self._account_details_cache is not None
+            and time.monotonic() < self._account_details_expiry
+        ):
+            return self._account_details_cache
+        return None
+
+    @classmethod
+    def _check_transfers(cls, transfers: List[dict]):
+        if not transfers:
+            raise ValueError("At least one transfer is required")
+
+        for transfer in transfers:
+            cls._check_currency(transfer["currency"])
+
+    @classmethod
+    def _render_order(
+        cls,
+        account_details: dict,
+        amount: float,
+        currency: str,
+        recipient: str,
+        account: str,
+        details: str,
+        bank_bik: str,
+    ) -> str:
+        config = cls._order_config(account_details)
+        config.update(
+            cls._transfer_config(
+                amount, currency, recipient, account, details, bank_bik
+            )
+        )
+        return render_order(config)
 
-    def _generate_url(self, endpoint):
-        return self.api_url + endpoint
+    @classmethod
+    def _render_batch_order(cls, account_details: dict, transfers: List[dict]) -> str:
+        config = cls._order_config(account_details)
+        config["NumberOfTransactions"] = str(len(transfers))
+
+        return render_batch_order(
+            config, [cls._transfer_config(**transfer) for transfer in transfers]
+        )
+
+    @staticmethod
+    def _check_currency(currency):
+        if currency not in SUPPORTED_CURRENCIES:
+            raise UnsupportedCurrencyException(
+                "Currency not supported. Please use any from this list: {}".format(
+                    _SUPPORTED_CURRENCIES_STR
+                )
+            )
+
+    @staticmethod
+    def _order_config(account_details: dict) -> dict:
+        # group header and debtor fields shared by every transfer of an order
+        code = secrets.token_hex(6)
+        # read the clock once so both dates agree, even around midnight
+        now = datetime.now().replace(microsecond=0)
+        return escape_values(
+            {
+                "MessageId": f"{account_details['AccountId']}-{code}",
+                "CreationDateTime": now.isoformat(),
+                "RequestedExecutionDate": now.date().isoformat(),
+                "DebtorName": account_details["AccountName"],
+                "DebtorAccount": account_details["AccountId"],
+            }
+        )
+
+    @staticmethod
+    def _transfer_config(
+        amount: float,
+        currency: str,
+        recipient: str,
+        account: str,
+        details: str,
+        bank_bik: str = "NOTPROVIDED",
+    ) -> dict:
+        return escape_values(
+            {
+                "Currency": currency,
+                "Amount": amount,
+                "CreditorBankBic": bank_bik,
+                "CreditorName": recipient,
+                "CreditorAccount": account,
+                "Description": details,
+            }
+        )
+
+
+class Trustpay(_TrustpayBase):
+    __slots__ = ("_session", "_session_lock")
+
+    def __init__(
+        self,
+        password,
+        username,
+        secret_key=None,
+        aid=None,
+        api_url=None,
+        debug=False,
+        account_details_ttl=DEFAULT_ACCOUNT_DETAILS_TTL,
+    ):
+        super().__init__(
+            password,
+            username,
+            secret_key=secret_key,
+            aid=aid,
+            api_url=api_url,
+            debug=debug,
+            account_details_ttl=account_details_ttl,
+        )
+
+        # http session is created on the first request
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Release pooled connections held by the http session
+        """
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def _get_session(self) -> requests.Session:
+        session = self._session
+        if session is None:
+            # threads making their first request at once must share one pool
+            with self._session_lock:
+                if self._session is None:
+                    self._session = self._create_session()
+                session = self._session
+        return session
+
+    @staticmethod
+    def _create_session() -> requests.Session:
+        # keep-alive connections to the api host are reused between calls;
+        # urllib3 doesn't retry POST on bad status codes, so orders are never resent
+        retries = Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504])
+        adapter = HTTPAdapter(
+            pool_connections=POOL_CONNECTIONS,
+            pool_maxsize=POOL_MAXSIZE,
+            max_retries=retries,
+        )
+        session = requests.Session()
+        # api_url may point to a plain http test server, pool those calls too
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def _prepare_headers(self, with_access_token=True):
+        # signature = self._make_signature(nonce, data, endpoint)
+        if with_access_token:
+            self.get_access_token()
+            return self._bearer_header
+
+        return self._basic_auth_header
 
     def _send_request(
         self,
         endpoint: str,
-        data: dict,
+        data: Union[dict, str],
         headers: dict,
         transform_data_func: Optional[callable],
     ):
@@ -116,21 +444,22 @@ class Trustpay:
         else:
             post_params = data
 
+        r = self._post(endpoint, headers, post_params)
+        if r.status_code == 401 and headers is self._bearer_header:
+            # the token was rejected before its reported expiry, refresh it and retry once
+            self._invalidate_access_token()
+            r = self._post(endpoint, self._prepare_headers(), post_params)
+
+        return self._parse_response(r)
+
+    def _post(self, endpoint: str, headers: dict, post_params) -> requests.Response:
+        url = self._generate_url(endpoint)
         if self.debug:
-            logger.info(
-                f"Trustpay request: url={self._generate_url(endpoint)}; body={post_params}"
-            )
-        r = requests.post(
-            self._generate_url(endpoint), headers=headers, data=post_params
-        )
+            logger.info("Trustpay request: url=%s; body=%s", url, post_params)
+        r = self._get_session().post(url, headers=headers, data=post_params)
         if self.debug:
-            logger.info(f"Trustpay reponse: {r.text}")
-        if r.status_code != HTTPStatus.OK:
-            raise PaymentException(
-                "Trustpay error: {}. Error code: {}".format(r.text, r.status_code)
-            )
-
-        return json.loads(r.text)
+            logger.info("Trustpay response: %s", r.content)
+        return r
 
     def get_access_token(self) -> str:
         """
@@ -139,19 +468,33 @@ class Trustpay:
             "token-type":"bearer",
         }
 
+        Tokens are shared between instances with the same username, password
+        and api_url and reused until shortly before they expire.
+
         :return access_token:str
         """
-        if self.access_token:
-            return self.access_token
+        with _TOKEN_CACHE_LOCK:
+            access_token = self._cached_access_token()
+            if access_token:
+                return access_token
+            fetch_lock = _TOKEN_FETCH_LOCKS.setdefault(
+                self._token_cache_key, threading.Lock()
+            )
 
-        endpoint = "/api/oauth2/token"
+        with fetch_lock:
+            # another thread may have fetched the token while we were waiting
+            with _TOKEN_CACHE_LOCK:
+                access_token = self._cached_access_token()
+            if access_token:
+                return access_token
 
-        data = {"grant_type": "client_credentials"}
+            endpoint = TOKEN_ENDPOINT
 
-        headers = self._prepare_headers(with_access_token=False)
+            headers = self._prepare_headers(with_access_token=False)
 
-        result = self._send_request(endpoint, data, headers, urlencode)
-        return result["access_token"]
+            result = self._send_request(endpoint, TOKEN_REQUEST_BODY, headers, None)
+            with _TOKEN_CACHE_LOCK:
+                return self._store_access_token(result)
 
     def account_details(self) -> dict:
         """
@@ -174,11 +517,27 @@ class Trustpay:
             }
         }
         """
-        endpoint = "/ApiBanking/GetAccountDetails"
+        endpoint = ACCOUNT_DETAILS_ENDPOINT
         data = {"AccountId": self.aid}
         headers = self._prepare_headers()
-        result = self._send_request(endpoint, data, headers, json.dumps)
-        return result["AccountDetails"]
+        result = self._send_request(endpoint, data, headers, _dumps)
+        return self._store_account_details(result)
+
+    def _account_details_for_order(self) -> dict:
+        # requests the account details when there are no recent ones cached
+        return self._cached_account_details() or self.account_details()
+
+    def _create_order(self, order_data: str) -> dict:
+        endpoint = CREATE_ORDER_ENDPOINT
+        data_to_send = {"Xml": order_data}
+        headers = self._prepare_headers()
+
+        try:
+            return self._send_request(endpoint, data_to_send, headers, _dumps)
+        except PaymentException:
+            # the order may have been rejected because of stale account details
+            self._account_details_cache = None
+            raise
 
     def send_money(
         self,
@@ -205,35 +564,34 @@ class Trustpay:
             "OrderId": 123123
             }
         """
-        if currency not in SUPPORTED_CURRENCIES:
-            # TODO: raise relevant error instead default
-            raise AttributeError(
-                "Currency not supported. Please use any from this list: {}".format(
-                    SUPPORTED_CURRENCIES
-                )
-            )
+        self._check_currency(currency)
 
-        endpoint = "/ApiBanking/CreateOrder"
-
-        account_details = self.account_details()
-        code = str(uuid.uuid4()).replace("-", "")[:12]
-        config = {
-            "MessageId": f"{account_details['AccountId']}-{code}",
-            "CreationDateTime": datetime.today().isoformat().split(".")[0],
-            "RequestedExecutionDate": date.today().isoformat(),
-            "DebtorName": account_details["AccountName"],
-            "DebtorAccount": account_details["AccountId"],
-            "Currency": currency,
-            "Amount": amount,
-            "CreditorBankBic": bank_bik,
-            "CreditorName": recipient,
-            "CreditorAccount": account,
-            "Description": details,
-        }
-        order_data = order_xml_string.format(**config).replace("\n", " ")
+        # account details are requested with the bearer token, so these calls
+        # can't overlap; both the token and the details are cached between orders
+        account_details = self._account_details_for_order()
+        order_data = self._render_order(
+            account_details, amount, currency, recipient, account, details, bank_bik
+        )
 
-        data_to_send = {"Xml": order_data}
-        headers = self._prepare_headers()
+        return self._create_order(order_data)
+
+    def send_money_batch(self, transfers: List[dict]) -> dict:
+        """
+        Transfer money from merchant account to several recipients with a single order
+        https://doc.trustpay.eu/?php#ab-create-order
+
+        :param transfers: list of dicts with the send_money keyword arguments:
+            amount, currency, recipient, account, details and optional bank_bik
+        :return: OrderId
+
+        Trustpay API response
+        Example: {
+            "OrderId": 123123
+            }
+        """
+        self._check_transfers(transfers)
+
+        account_details = self._account_details_for_order()
+        order_data = self._render_batch_order(account_details, transfers)
 
-        # TODO: error handling
-        return self._send_request(endpoint, data_to_send, headers, json.dumps)
+        return self._create_order(order_data)